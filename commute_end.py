@@ -1,104 +1,327 @@
 import os
-import requests
+import time
+import base64
+import asyncio
+import threading
+import hashlib
+import random
+import aiohttp
+import orjson
 from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
 import gspread
 from google.oauth2.service_account import Credentials
 import logging
-import pytz
+import atexit
+import queue
+from logging.handlers import QueueHandler, QueueListener
 import json
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
+from gspread.utils import absolute_range_name
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential_jitter
 
-# 로깅 설정
-logging.basicConfig(level=logging.INFO)
+# 로깅 설정 (출력은 QueueListener 백그라운드 스레드에서 처리)
+log_queue = queue.Queue(-1)
+logging.basicConfig(level=logging.INFO, handlers=[QueueHandler(log_queue)])
+log_listener = QueueListener(log_queue, logging.StreamHandler())
+log_listener.start()
+atexit.register(log_listener.stop)
 logger = logging.getLogger(__name__)
 
-class KurlyDataCollector:
-    def __init__(self):
-        # 세션 설정 및 재시도 전략
-        self.session = requests.Session()
-        retry_strategy = Retry(
-            total=3,
-            backoff_factor=0.5,
-            status_forcelist=[500, 502, 503, 504]
-        )
-        adapter = HTTPAdapter(max_retries=retry_strategy)
-        self.session.mount("https://", adapter)
+MAX_CONCURRENCY = 8  # 페이지 동시 요청 수 (API 레이트 리밋 보호)
+KST = ZoneInfo("Asia/Seoul")
+PAGE_SIZE = 200  # 페이지 수(왕복 횟수)를 줄이기 위한 큰 페이지 크기
+MAX_RETRIES = 5
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+RETRY_BACKOFF = 0.5  # 지수 백오프 기본 대기 시간(초)
+RETRY_JITTER = 1.0  # 동시 재시도가 겹치지 않도록 더하는 최대 무작위 대기(초)
+RETRY_MAX_WAIT = 30
+TOKEN_DEFAULT_TTL = 30 * 60  # exp 클레임이 없을 때 사용할 토큰 유효 시간(초)
+TOKEN_EXPIRY_MARGIN = 60  # 만료 직전 토큰은 미리 갱신
+
+# 시트 데이터 영역 (A2:H1000)
+SHEET_LAST_ROW = 1000
+SHEET_FIELDS = (
+    'name',
+    'teamName',
+    'userId',
+    'centerShiftHourType',
+    'startWorkDateTime',
+    'endWorkDateTime',
+    'overWorkMinuteTime',
+    'overWorkStartMinuteTime'
+)
+SHEET_COLUMNS = len(SHEET_FIELDS)
+# 데이터 영역 전체(2행~마지막 행)를 지우는 빈 행 (행마다 별도 리스트)
+BLANK_ROWS = [[""] * SHEET_COLUMNS for _ in range(SHEET_LAST_ROW - 1)]
+
+# 시트별 마지막 업데이트 데이터 해시 (워크플로 캐시로 실행 간 유지)
+STATE_FILE = os.environ.get('KURLY_STATE_FILE', '.kurly_state.json')
+
+def create_session():
+    """keep-alive 커넥션 풀을 사용하는 공용 HTTP 세션 생성"""
+    connector = aiohttp.TCPConnector(
+        limit=MAX_CONCURRENCY * 2,
+        limit_per_host=MAX_CONCURRENCY,
+        keepalive_timeout=60
+    )
+    return aiohttp.ClientSession(
+        connector=connector,
+        headers={'Accept-Encoding': 'gzip, deflate'}
+    )
+
+def get_token_expiry(token):
+    """JWT payload의 exp 클레임 추출 (디코딩 실패 시 None)"""
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+    except Exception:
+        return None
+
+def retry_delay(attempt, retry_after=None):
+    """Retry-After 헤더가 있으면 그 값을, 없으면 지수 백오프 + 지터를 대기 시간으로 사용"""
+    if retry_after:
+        try:
+            return min(float(retry_after), RETRY_MAX_WAIT)
+        except ValueError:
+            pass  # HTTP-date 형식은 백오프로 대체
+    return min(RETRY_BACKOFF * (2 ** attempt), RETRY_MAX_WAIT) + random.uniform(0, RETRY_JITTER)
+
+def is_retryable_api_error(e):
+    """레이트 리밋(429) 및 일시적 서버 오류 여부"""
+    return (
+        isinstance(e, gspread.exceptions.APIError)
+        and e.response.status_code in RETRY_STATUSES
+    )
+
+class KurlyClient:
+    """Kurly API 수집 및 Google Sheets 업데이트 (세션/토큰/워크북 공유)"""
+    def __init__(self, session):
+        # 하나의 aiohttp 세션을 전체 실행 동안 공유
+        self.session = session
+        self.semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+        
+        # 인증 토큰과 만료 시각 (모든 요청이 공유)
+        self.token = None
+        self._token_expires_at = 0.0
+        self.login_lock = asyncio.Lock()
         
-        # 인증 토큰
+        # 진행 중인 동일 요청은 하나의 태스크 결과를 공유
+        self._inflight = {}
+
+        # gspread 클라이언트/워크북은 한 번만 인증해서 재사용
+        self._gc = None
+        self._wb = None
+        self._gspread_lock = threading.Lock()
+
+    def token_expired(self):
+        """토큰이 없거나 곧 만료되는지 여부"""
+        return self.token is None or time.time() >= self._token_expires_at - TOKEN_EXPIRY_MARGIN
+
+    def invalidate_token(self):
+        """캐시된 토큰 폐기 (다음 요청 시 재로그인)"""
         self.token = None
+        self._token_expires_at = 0.0
+
+    async def coalesce(self, key, factory):
+        """같은 key의 요청이 진행 중이면 새로 요청하지 않고 그 결과를 대기"""
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # 한 호출자가 취소되어도 공유 태스크는 계속 진행
+        return await asyncio.shield(task)
+
+    async def request_json(self, method, url, **kwargs):
+        """429/5xx 응답 및 연결 오류 시 재시도하는 JSON 요청"""
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                async with self.session.request(method, url, **kwargs) as response:
+                    if response.status in RETRY_STATUSES and attempt < MAX_RETRIES:
+                        delay = retry_delay(attempt, response.headers.get('Retry-After'))
+                    else:
+                        response.raise_for_status()
+                        return await response.json(loads=orjson.loads)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt == MAX_RETRIES:
+                    raise
+                delay = retry_delay(attempt)
+            await asyncio.sleep(delay)
         
-    def login(self):
+    async def login(self):
         """로그인 및 토큰 획득"""
         login_id = os.environ.get('KURLY_LOGIN_ID')
         password = os.environ.get('KURLY_PASSWORD')
         
-        login_response = self.session.post(
+        login_response = await self.request_json(
+            "POST",
             "https://api-lms.kurly.com/v1/admin-accounts/login",
             json={"loginId": login_id, "password": password}
         )
-        login_response.raise_for_status()
-        self.token = login_response.json()['data']['token']
+        self.token = login_response['data']['token']
+        self._token_expires_at = get_token_expiry(self.token) or time.time() + TOKEN_DEFAULT_TTL
         self.session.headers.update({'authorization': f'Bearer {self.token}'})
 
-    def get_page_data(self, url, params):
-        """단일 페이지 데이터 수집"""
+    async def ensure_token(self):
+        """토큰이 없거나 만료된 경우에만 로그인"""
+        async with self.login_lock:
+            if self.token_expired():
+                await self.login()
+
+    async def authorized_json(self, method, url, **kwargs):
+        """인증이 필요한 요청 (401 응답 시 재로그인 후 한 번 재시도)"""
+        await self.ensure_token()
+        token = self.token
         try:
-            response = self.session.get(url, params=params)
-            response.raise_for_status()
-            return response.json()['data']['content']
-        except Exception as e:
-            logger.error(f"Error fetching page {params['page']}: {str(e)}")
-            return []
+            return await self.request_json(method, url, **kwargs)
+        except aiohttp.ClientResponseError as e:
+            if e.status != 401:
+                raise
+            # 다른 요청이 이미 재로그인했다면 새 토큰을 그대로 사용
+            if self.token == token:
+                self.invalidate_token()
+            await self.ensure_token()
+            return await self.request_json(method, url, **kwargs)
+
+    async def get_page_data(self, url, params):
+        """단일 페이지 데이터 수집"""
+        return await self.coalesce(
+            ('page', url, tuple(params.items())),
+            lambda: self._fetch_page(url, params)
+        )
+
+    async def _fetch_page(self, url, params):
+        async with self.semaphore:
+            try:
+                response = await self.authorized_json("GET", url, params=params)
+                return response['data']['content']
+            except Exception as e:
+                logger.error("Error fetching page %s: %s", params['page'], e)
+                return []
 
-    def get_data(self, date):
-        """날짜별 데이터 수집"""
+    async def fetch(self, start_date, end_date):
+        """기간별 데이터 수집"""
+        return await self.coalesce(
+            ('data', start_date, end_date),
+            lambda: self._fetch_data(start_date, end_date)
+        )
+
+    async def _fetch_data(self, start_date, end_date):
         try:
-            if not self.token:
-                self.login()
-            
             url = "https://api-lms.kurly.com/v1/commutes/end"
+            # aiohttp는 bool 쿼리 값을 허용하지 않으므로 문자열로 전달
             initial_params = {
                 "page": 1,
-                "size": 30,  # 원래 페이지 크기로 복원
+                "size": PAGE_SIZE,
                 "cluster": "CC03",
                 "center": "GPM1",
                 "workPart": "IB",
-                "isEndWork": False,
-                "isEarlyEndWork": False,
-                "isOverWork": False,
-                "isEarlyStartWork": False,
-                "startDate": date,
-                "endDate": date
+                "isEndWork": "False",
+                "isEarlyEndWork": "False",
+                "isOverWork": "False",
+                "isEarlyStartWork": "False",
+                "startDate": start_date,
+                "endDate": end_date
             }
             
             # 첫 페이지 요청으로 총 페이지 수 확인
-            first_response = self.session.get(url, params=initial_params)
-            first_response.raise_for_status()
-            data = first_response.json()['data']
+            async with self.semaphore:
+                first_response = await self.authorized_json("GET", url, params=initial_params)
+            data = first_response['data']
             total_pages = data['totalPages']
-            result = data['content']
-
-            # 병렬로 나머지 페이지 데이터 수집
-            if total_pages > 1:
-                with ThreadPoolExecutor(max_workers=4) as executor:
-                    future_to_page = {
-                        executor.submit(
-                            self.get_page_data,
-                            url,
-                            {**initial_params, "page": page}
-                        ): page
-                        for page in range(2, total_pages + 1)
-                    }
-                    
-                    for future in as_completed(future_to_page):
-                        result.extend(future.result())
+            content = data['content']
+            if total_pages <= 1:
+                return content
+
+            # 전체 건수만큼 미리 할당 후 페이지 순서대로 채움
+            total = data.get('totalElements') or total_pages * initial_params['size']
+            result = [None] * total
+            result[:len(content)] = content
+            index = len(content)
+
+            # 나머지 페이지를 동시에 요청 (gather는 페이지 순서를 유지)
+            pages = await asyncio.gather(*(
+                self.get_page_data(url, {**initial_params, "page": page})
+                for page in range(2, total_pages + 1)
+            ))
+            for page_content in pages:
+                result[index:index + len(page_content)] = page_content
+                index += len(page_content)
+            del result[index:]
 
             return result
 
         except Exception as e:
-            logger.error(f"Error in get_data: {str(e)}")
+            logger.error("Error in fetch: %s", e)
+            raise
+
+    def get_workbook(self):
+        """인증된 gspread 클라이언트와 워크북을 지연 생성 후 재사용"""
+        with self._gspread_lock:
+            if self._gc is None:
+                self._gc = gspread.authorize(get_google_credentials())
+            if self._wb is None:
+                self._wb = self._gc.open("newdashboard raw")
+            return self._wb
+
+    def reset_workbook(self):
+        """캐시된 gspread 클라이언트/워크북 폐기 (다음 호출 시 재인증)"""
+        with self._gspread_lock:
+            self._gc = None
+            self._wb = None
+
+    async def prepare_workbook(self):
+        """Kurly API 수집과 동시에 Google 인증/워크북 열기를 미리 수행"""
+        try:
+            await asyncio.to_thread(self.get_workbook)
+        except Exception as e:
+            # 실패해도 시트 업데이트 시점에 다시 시도
+            logger.warning("Error preparing workbook: %s", e)
+
+    @retry(
+        retry=retry_if_exception(is_retryable_api_error),
+        wait=wait_exponential_jitter(initial=1, max=RETRY_MAX_WAIT),
+        stop=stop_after_attempt(MAX_RETRIES),
+        reraise=True
+    )
+    def write_worksheet(self, worksheet_name, data):
+        """워크시트 내용을 values.batchUpdate 한 번으로 교체"""
+        if not data:
+            return
+
+        # 범위를 명시해 Sheets API가 범위를 추론하지 않도록 함
+        last_data_row = len(data) + 1
+        value_ranges = [
+            {"range": absolute_range_name(worksheet_name, f"A2:H{last_data_row}"), "values": data}
+        ]
+        # 데이터 아래 남은 행은 빈 값으로 덮어써 이전 내용 삭제 (batch_clear 대체)
+        first_blank_row = last_data_row + 1
+        if first_blank_row <= SHEET_LAST_ROW:
+            value_ranges.append({
+                "range": absolute_range_name(worksheet_name, f"A{first_blank_row}:H{SHEET_LAST_ROW}"),
+                "values": BLANK_ROWS[len(data):]
+            })
+
+        self.get_workbook().values_batch_update(
+            body={"valueInputOption": "RAW", "data": value_ranges}
+        )
+        logger.info("Updated %d rows in %s", len(data), worksheet_name)
+
+    def update_sheet(self, worksheet_name, data):
+        """Google Sheets 업데이트 (GitHub Secrets 사용)"""
+        try:
+            try:
+                self.write_worksheet(worksheet_name, data)
+            except gspread.exceptions.APIError as e:
+                if e.response.status_code != 401:
+                    raise
+                # 인증 만료 시 클라이언트를 새로 만들어 한 번 재시도
+                self.reset_workbook()
+                self.write_worksheet(worksheet_name, data)
+
+        except Exception as e:
+            logger.error("Error in spreadsheet update: %s", e)
             raise
 
 def get_google_credentials():
@@ -119,87 +342,132 @@ def get_google_credentials():
 
         return Credentials.from_service_account_info(credentials_dict, scopes=scope)
     except json.JSONDecodeError as e:
-        logger.error(f"JSON parsing error: {str(e)}")
+        logger.error("JSON parsing error: %s", e)
         raise
     except Exception as e:
-        logger.error(f"Credential error: {str(e)}")
+        logger.error("Credential error: %s", e)
+        raise
+
+def cell_value(value):
+    """null은 빈 문자열로 변환 (Sheets API는 null 셀을 건너뛰어 이전 값이 남음)"""
+    return '' if value is None else value
+
+def process_data(response):
+    """데이터 처리"""
+    try:
+        # 행은 튜플로 생성 (JSON 직렬화 결과는 리스트와 동일)
+        return [
+            tuple(map(cell_value, map(item.get, SHEET_FIELDS)))
+            for item in response
+        ]
+    except Exception as e:
+        logger.error("Error processing data: %s", e)
         raise
 
-def update_spreadsheet(worksheet_name, data):
-    """Google Sheets 업데이트 (GitHub Secrets 사용)"""
+def load_state():
+    """이전 실행에서 저장한 시트별 데이터 해시 로드"""
     try:
-        creds = get_google_credentials()
-        client = gspread.authorize(creds)
+        with open(STATE_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
 
-        workbook = client.open("newdashboard raw")
-        worksheet = workbook.worksheet(worksheet_name)
+def save_state(state):
+    """시트별 데이터 해시 저장"""
+    try:
+        with open(STATE_FILE, 'w') as f:
+            json.dump(state, f)
+    except OSError as e:
+        logger.warning("Error saving state: %s", e)
+
+def data_digest(data):
+    """시트에 쓸 데이터의 해시"""
+    return hashlib.blake2b(orjson.dumps(data), digest_size=16).hexdigest()
 
-        if data:
-            worksheet.batch_clear(["A2:H1000"])
-            worksheet.update('A2', data)
-            print(f"Updated {len(data)} rows in {worksheet_name}")
+def split_by_date(data, dates):
+    """startWorkDateTime의 날짜 기준으로 데이터 분리 (분류되지 않은 건수는 경고)"""
+    result = {date: [] for date in dates}
+    missing_start = 0
+    unmatched = 0
+    for item in data:
+        start = item.get('startWorkDateTime')
+        if not start:
+            missing_start += 1
+            continue
+        rows = result.get(start[:10])
+        if rows is None:
+            unmatched += 1
+        else:
+            rows.append(item)
+
+    if missing_start:
+        logger.warning("Dropped %d records without startWorkDateTime", missing_start)
+    if unmatched:
+        logger.warning(
+            "Dropped %d records with startWorkDateTime outside %s",
+            unmatched, ", ".join(dates)
+        )
+    return result
 
+async def refresh_sheet(client, state, sheet_name, date, data):
+    """변경된 경우에만 시트 업데이트"""
+    try:
+        processed_data = process_data(data)
+        if processed_data:
+            digest = data_digest(processed_data)
+            if state.get(sheet_name) == digest:
+                logger.info("No changes in %s, skipping update", sheet_name)
+                return
+            await asyncio.to_thread(client.update_sheet, sheet_name, processed_data)
+            state[sheet_name] = digest
     except Exception as e:
-        print(f"Error in spreadsheet update: {str(e)}")
-        raise
+        logger.error("Error processing %s: %s", date, e)
 
-def process_data(response):
-    """데이터 처리"""
+async def collect(client, state, sheets):
+    """전체 기간 데이터를 한 번에 수집해 날짜별 시트 업데이트"""
+    dates = list(sheets.values())
     try:
-        result = []
-        for item in response:
-            processed_item = [
-                item.get('name', ''),
-                item.get('teamName', ''),
-                item.get('userId', ''),
-                item.get('centerShiftHourType', ''),
-                item.get('startWorkDateTime', ''),
-                item.get('endWorkDateTime', ''),
-                item.get('overWorkMinuteTime', ''),
-                item.get('overWorkStartMinuteTime', '')
-            ]
-            result.append(processed_item)
-        return result
+        data = await client.fetch(min(dates), max(dates))
     except Exception as e:
-        logger.error(f"Error processing data: {str(e)}")
-        raise
+        logger.error("Error collecting %s ~ %s: %s", min(dates), max(dates), e)
+        return
+
+    data_by_date = split_by_date(data, dates)
+    await asyncio.gather(*(
+        refresh_sheet(client, state, sheet_name, date, data_by_date[date])
+        for sheet_name, date in sheets.items()
+    ))
 
-def main():
+async def main():
     try:
         logger.info("Starting data collection")
         start_time = datetime.now()
         
-        collector = KurlyDataCollector()
-        
         # 한국 시간 기준 날짜 계산
-        korean_tz = pytz.timezone('Asia/Seoul')
-        now = datetime.now(korean_tz)
+        now = datetime.now(KST)
         today_str = now.strftime("%Y-%m-%d")
         yesterday_str = (now - timedelta(days=1)).strftime("%Y-%m-%d")
         
-        # 병렬로 오늘/어제 데이터 수집 및 처리
-        with ThreadPoolExecutor(max_workers=2) as executor:
-            future_to_date = {
-                executor.submit(collector.get_data, today_str): ("today_kurlyro", today_str),
-                executor.submit(collector.get_data, yesterday_str): ("yesterday_kurlyro", yesterday_str)
-            }
+        state = load_state()
+        async with create_session() as session:
+            client = KurlyClient(session)
             
-            for future in as_completed(future_to_date):
-                sheet_name, date = future_to_date[future]
-                try:
-                    data = future.result()
-                    processed_data = process_data(data)
-                    if processed_data:
-                        update_spreadsheet(sheet_name, processed_data)
-                except Exception as e:
-                    logger.error(f"Error processing {date}: {str(e)}")
+            # 워크북 준비와 어제~오늘 데이터 수집을 동시에 진행
+            await asyncio.gather(
+                client.prepare_workbook(),
+                collect(client, state, {
+                    "today_kurlyro": today_str,
+                    "yesterday_kurlyro": yesterday_str
+                })
+            )
+        save_state(state)
 
         execution_time = datetime.now() - start_time
-        logger.info(f"Completed in {execution_time.total_seconds():.2f} seconds")
+        logger.info("Completed in %.2f seconds", execution_time.total_seconds())
         
     except Exception as e:
-        logger.error(f"Error in main function: {str(e)}")
+        logger.error("Error in main function: %s", e)
         raise
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())